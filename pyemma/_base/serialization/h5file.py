@@ -19,7 +19,7 @@
 import logging
 import numpy as np
 from io import BytesIO
-from .pickle_extensions import HDF5PersistentPickler
+from .pickle_extensions import HDF5PersistentPickler, CHUNK_CACHE_OPTIONS
 
 __author__ = 'marscher'
 
@@ -38,7 +38,7 @@ class H5File(object):
 
     def __init__(self, file_name, model_name=None, mode='r'):
         import h5py
-        self._file = h5py.File(file_name, mode=mode)
+        self._file = h5py.File(file_name, mode=mode, **CHUNK_CACHE_OPTIONS)
         self._parent = self._file.require_group('pyemma')
         self._current_model_group = model_name
 
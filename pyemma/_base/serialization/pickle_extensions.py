@@ -16,25 +16,40 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
+import sys
+from contextlib import contextmanager
+from io import BytesIO
 from pickle import Pickler, Unpickler, UnpicklingError
 
 import numpy as np
 import logging
 
+# importing either of these registers the BLOSC filter with h5py.
 try:
-    import tables
-except:
-    pass
+    import hdf5plugin
+except ImportError:
+    try:
+        import tables
+    except:
+        pass
+
+try:
+    import blosc
+except ImportError:
+    blosc = None
 
 logger = logging.getLogger(__name__)
 
 __author__ = 'marscher'
 
 
-def _blosc_opts(complevel=9, complib='blosc:lz4', shuffle=True):
+_BLOSC_COMPRESSORS = ('blosclz', 'lz4', 'lz4hc', 'snappy', 'zlib', 'zstd')
+
+
+def _blosc_opts(complevel=5, complib='blosc:lz4', shuffle='bit'):
     shuffle = 2 if shuffle == 'bit' else 1 if shuffle else 0
-    compressors = ['blosclz', 'lz4', 'lz4hc', 'snappy', 'zlib', 'zstd']
-    complib = ['blosc:' + c for c in compressors].index(complib)
+    complib = ['blosc:' + c for c in _BLOSC_COMPRESSORS].index(complib)
     args = {
         'compression': 32001,
         'compression_opts': (0, 0, 0, 0, complevel, shuffle, complib)
@@ -44,6 +59,9 @@ def _blosc_opts(complevel=9, complib='blosc:lz4', shuffle=True):
     return args
 
 
+_LZF_OPTIONS = {'compression': 'lzf', 'shuffle': True}
+
+
 def _check_blosc_avail():
     import tempfile, h5py
     blosc_opts = _blosc_opts()
@@ -55,9 +73,9 @@ def _check_blosc_avail():
             except ValueError as ve:
                 if 'Unknown compression filter' in str(ve):
                     import warnings
-                    warnings.warn('BLOSC compression filter unavailable. '
-                                  'Your resulting file may be large and not optimal to process.')
-                    return {}
+                    warnings.warn('BLOSC compression filter unavailable, falling back to LZF. '
+                                  'Install hdf5plugin for faster saving and loading of models.')
+                    return _LZF_OPTIONS
                 else:  # unknown exception
                     raise
             else:
@@ -73,94 +91,273 @@ def _check_blosc_avail():
 # we cache this during runtime
 _DEFAULT_BLOSC_OPTIONS = _check_blosc_avail()
 
+# arrays smaller than this are stored contiguously (no chunk index, no filter pipeline).
+_CONTIGUOUS_MAX_BYTES = 64 * 1024
+# targeted size of a single chunk for larger arrays.
+_CHUNK_BYTES = 512 * 1024
+# raw data chunk cache settings for files holding pickled models, large enough for several chunks.
+CHUNK_CACHE_OPTIONS = {'rdcc_nbytes': 64 * 1024 * 1024, 'rdcc_nslots': 10007, 'rdcc_w0': 0.75}
+# arrays up to this size are pickled inline.
+_INLINE_MAX_BYTES = 64
+# arrays smaller than this are packed together into one dataset.
+_SMALL_ARRAY_MAX_BYTES = 64 * 1024
+# offsets of packed arrays are aligned to this many bytes, so that we can return views on load.
+_SMALL_ARRAY_ALIGNMENT = 16
+_SMALL_ARRAYS_KEY = 'small_arrays'
+# arrays up to this size are identified by their content, larger ones by their id (hashing would dominate).
+_DIGEST_MAX_BYTES = 16 * 1024 * 1024
+# arrays larger than this are compressed by python-blosc (if available) and written chunk-wise.
+_DIRECT_CHUNK_MIN_BYTES = 1024 * 1024
+
+
+def _pick_chunks(shape, dtype, chunk_bytes=_CHUNK_BYTES):
+    """ Determine the chunk shape for an array to be stored in HDF5.
+
+    Returns None for small arrays, which should be stored contiguously. Otherwise the leading
+    axes are split until a chunk holds at most chunk_bytes.
+    """
+    itemsize = np.dtype(dtype).itemsize
+    if int(np.prod(shape)) * itemsize < _CONTIGUOUS_MAX_BYTES:
+        return None
+    chunks = list(shape)
+    for axis in range(len(chunks)):
+        nbytes = int(np.prod(chunks)) * itemsize
+        if nbytes <= chunk_bytes:
+            break
+        bytes_per_index = nbytes // chunks[axis]
+        chunks[axis] = max(1, chunk_bytes // bytes_per_index)
+    return tuple(chunks)
+
+
+@contextmanager
+def _patch_topology(name, func):
+    # temporarily set mdtraj.Topology.<name> to func, this is a lot cheaper than unittest.mock.patch.
+    from mdtraj import Topology
+    missing = object()
+    old = Topology.__dict__.get(name, missing)
+    setattr(Topology, name, func)
+    try:
+        yield
+    finally:
+        if old is missing:
+            delattr(Topology, name)
+        else:
+            setattr(Topology, name, old)
+
+
+def _can_write_direct_chunks(array):
+    return (blosc is not None and _DEFAULT_BLOSC_OPTIONS.get('compression') == 32001
+            and array.nbytes > _DIRECT_CHUNK_MIN_BYTES and array.dtype.itemsize <= blosc.MAX_TYPESIZE)
+
+
+def _write_direct_chunks(dset, array, chunks):
+    """ Compress array chunk-wise with blosc and write the chunks directly, bypassing the HDF5 filter pipeline.
+
+    The chunks are regular BLOSC frames, so the dataset is read through the HDF5 BLOSC filter as usual.
+    """
+    _, _, _, _, clevel, shuffle, complib = _DEFAULT_BLOSC_OPTIONS['compression_opts']
+    cname = _BLOSC_COMPRESSORS[complib]
+    # edge chunks have to be padded to the full chunk shape.
+    padded = np.zeros(chunks, dtype=array.dtype)
+    grid = [-(-n // c) for n, c in zip(array.shape, chunks)]
+    for index in np.ndindex(*grid):
+        offset = tuple(i * c for i, c in zip(index, chunks))
+        block = array[tuple(slice(o, o + c) for o, c in zip(offset, chunks))]
+        if block.shape == chunks and block.flags.c_contiguous:
+            chunk = block
+        else:
+            padded[tuple(slice(0, n) for n in block.shape)] = block
+            chunk = padded
+        data = blosc.compress_ptr(chunk.__array_interface__['data'][0], chunk.size, typesize=chunk.itemsize,
+                                  clevel=clevel, shuffle=shuffle, cname=cname)
+        dset.id.write_direct_chunk(offset, data)
+
+
+def _digest(array):
+    # content based key of an array, includes shape and full dtype description.
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr((array.shape, array.dtype.descr)).encode())
+    h.update(np.ascontiguousarray(array).reshape(-1).view(np.uint8))
+    return h.hexdigest()
+
 
 class HDF5PersistentPickler(Pickler):
     # stores numpy arrays during pickling in given hdf5 group.
     def __init__(self, group, file):
+        # stay at protocol 4, protocol 5 files could not be loaded on Python 3.7.
         super().__init__(file=file, protocol=4)
         self.group = group
-        self._seen_ids = set()
+        # id(array) -> (array, persistent id). Holding a reference to the array prevents its id from being reused.
+        self._seen = {}
+        # content digest -> persistent id of the stored array.
+        self._stored = {}
+        self._n_copies = 0
+        self._small_arrays = BytesIO()
+        # (array, key) of arrays getting their own dataset, these are created after pickling.
+        self._pending = []
+        # a chunk should always fit into the chunk cache of the file.
+        rdcc_nbytes = group.file.id.get_access_plist().get_cache()[2]
+        self._chunk_bytes = max(_CONTIGUOUS_MAX_BYTES, min(_CHUNK_BYTES, rdcc_nbytes))
 
     def dump(self, *args, **kwargs):
-        # we temporarily patch mdtraj.Topology to save state to numpy array
-        from unittest import mock
-        from pyemma._base.serialization.mdtraj_helpers import getstate
-        with mock.patch('mdtraj.Topology.__getstate__', getstate, create=True):
+        # we temporarily patch mdtraj.Topology to save state to numpy array. If mdtraj has not been imported,
+        # there can not be any topology to save.
+        if 'mdtraj' in sys.modules:
+            from pyemma._base.serialization.mdtraj_helpers import getstate
+            with _patch_topology('__getstate__', getstate):
+                super(HDF5PersistentPickler, self).dump(*args, **kwargs)
+        else:
             super(HDF5PersistentPickler, self).dump(*args, **kwargs)
+        self._flush_datasets()
+        self._flush_small_arrays()
+
+    def _flush_datasets(self):
+        # create and fill all datasets in one go, instead of interleaving this with pickling.
+        for array, key in self._pending:
+            self._store_dataset(array, key)
+        self._pending = []
+
+    def _flush_small_arrays(self):
+        # write all packed small arrays as a single byte dataset.
+        if not self._small_arrays.tell():
+            return
+        blob = np.frombuffer(self._small_arrays.getbuffer(), dtype=np.uint8)
+        chunks = _pick_chunks(blob.shape, blob.dtype, self._chunk_bytes)
+        compression = _DEFAULT_BLOSC_OPTIONS if chunks is not None else {}
+        self.group.create_dataset(name=_SMALL_ARRAYS_KEY, data=blob, chunks=chunks,
+                                  track_times=False, **compression)
+        self._small_arrays = BytesIO()
+
+    def _store_small(self, array):
+        # appends the raw bytes of array to the packed buffer and returns its offset.
+        buf = self._small_arrays
+        offset = buf.tell()
+        padding = -offset % _SMALL_ARRAY_ALIGNMENT
+        if padding:
+            buf.write(b'\0' * padding)
+            offset += padding
+        buf.write(np.ascontiguousarray(array).reshape(-1).view(np.uint8))
+        return offset
+
+    def _store_dataset(self, array, key):
+        chunks = _pick_chunks(array.shape, array.dtype, self._chunk_bytes)
+        # filters require a chunked layout, small arrays are not worth compressing anyway.
+        compression = _DEFAULT_BLOSC_OPTIONS if chunks is not None else {}
+        dset = self.group.create_dataset(name=key, shape=array.shape, dtype=array.dtype, chunks=chunks,
+                                         track_times=False, **compression)
+        if chunks is not None and _can_write_direct_chunks(array):
+            _write_direct_chunks(dset, array, chunks)
+        else:
+            # write from the buffer directly, this only copies if the array is not C-contiguous.
+            dset.write_direct(np.require(array, requirements='C'))
 
     def _store(self, array):
-        id_ = id(array)
-        key = str(id_)
-        # this actually makes no sense to check it here, however it is needed,
-        # since there seems to be some race condition in h5py...
-        if key in self.group:
-            assert id_ in self._seen_ids
-            return id_
-        self._seen_ids.add(id_)
-        self.group.create_dataset(name=key, data=array,
-                                  chunks=True, **_DEFAULT_BLOSC_OPTIONS)
-        return id_
+        # stores array and returns its persistent id. Arrays with equal contents are only stored once,
+        # repeated occurrences refer to the first one and are restored as copies of it.
+        digest = _digest(array) if array.nbytes <= _DIGEST_MAX_BYTES else None
+        if digest is not None:
+            stored = self._stored.get(digest)
+            if stored is not None:
+                self._n_copies += 1
+                return 'np_array_copy', self._n_copies, stored
+        if array.nbytes < _SMALL_ARRAY_MAX_BYTES:
+            pid = 'np_array_small', self._store_small(array), array.shape, array.dtype
+        else:
+            key = digest if digest is not None else str(id(array))
+            self._pending.append((array, key))
+            pid = 'np_array', key
+        if digest is not None:
+            self._stored[digest] = pid
+        return pid
 
     def persistent_id(self, obj):
-        if (isinstance(obj, np.ndarray) and obj.dtype != np.object_
-                and id(obj) not in self._seen_ids):
-            # do not store empty arrays in hdf (more overhead)
-            if not len(obj):
+        if isinstance(obj, np.ndarray) and not obj.dtype.hasobject:
+            # do not store scalars, empty and tiny arrays in hdf (more overhead), these are pickled inline.
+            if obj.ndim == 0 or obj.nbytes <= _INLINE_MAX_BYTES:
                 return None
-            array_id = self._store(obj)
-            return 'np_array', array_id
+            # arrays referenced multiple times are only stored once.
+            seen = self._seen.get(id(obj))
+            if seen is not None:
+                return seen[1]
+            pid = self._store(obj)
+            self._seen[id(obj)] = obj, pid
+            return pid
 
         return None
 
 
 class HDF5PersistentUnpickler(Unpickler):
-    __allowed_packages = ('builtin',
-                          'pyemma',
-                          'mdtraj',
-                          'numpy',
-                          'scipy',
-                          'bhmm',
-                          'deeptime'
-                          )
+    __allowed_packages = frozenset(('builtin',
+                                    'pyemma',
+                                    'mdtraj',
+                                    'numpy',
+                                    'scipy',
+                                    'bhmm',
+                                    'deeptime'
+                                    ))
 
     def __init__(self, group, file):
         super().__init__(file=file)
         self.group = group
+        self._small_arrays = None
+        # persistent id -> restored array, so that shared arrays are only read once and stay shared.
+        self._loaded = {}
+        # (module, name) -> resolved class, so every class reference is checked and looked up only once.
+        self._classes = {}
 
     def persistent_load(self, pid):
         # This method is invoked whenever a persistent ID is encountered.
-        # Here, pid is the type and the dataset id.
-        type_tag, key_id = pid
+        # Here, pid is the type and the dataset id (or the location of a packed array).
+        arr = self._loaded.get(pid)
+        if arr is not None:
+            return arr
+        type_tag, *key = pid
         if type_tag == "np_array":
-            return self.group[str(key_id)][:]
+            key_id, = key
+            dset = self.group[str(key_id)]
+            # read (and decompress) straight into the result, without an intermediate buffer.
+            arr = np.empty(dset.shape, dtype=dset.dtype)
+            if arr.size:
+                dset.read_direct(arr)
+        elif type_tag == "np_array_small":
+            offset, shape, dtype = key
+            if self._small_arrays is None:
+                self._small_arrays = self.group[_SMALL_ARRAYS_KEY][...]
+            nbytes = int(np.prod(shape)) * dtype.itemsize
+            arr = self._small_arrays[offset:offset + nbytes].view(dtype).reshape(shape)
+        elif type_tag == "np_array_copy":
+            _, original = key
+            arr = self.persistent_load(original).copy()
         else:
             # Always raises an error if you cannot return the correct object.
             # Otherwise, the unpickler will think None is the object referenced
             # by the persistent ID.
             raise UnpicklingError("unsupported persistent object")
+        self._loaded[pid] = arr
+        return arr
 
     def load(self, *args, **kwargs):
         # we temporarily patch mdtraj.Topology to load state from numpy array
-        from unittest import mock
         from pyemma._base.serialization.mdtraj_helpers import setstate
-        with mock.patch('mdtraj.Topology.__setstate__', setstate, create=True):
+        with _patch_topology('__setstate__', setstate):
             return super(HDF5PersistentUnpickler, self).load(*args, **kwargs)
 
     @staticmethod
     def __check_allowed(module):
         # check if we are allowed to unpickle from these modules.
-        i = module.find('.')
-        if i > 0:
-            package = module[:i]
-        else:
-            package = module
+        package = module.partition('.')[0]
         if package not in HDF5PersistentUnpickler.__allowed_packages:
             raise UnpicklingError('{mod} not allowed to unpickle'.format(mod=module))
 
     def find_class(self, module, name):
+        try:
+            return self._classes[(module, name)]
+        except KeyError:
+            pass
         self.__check_allowed(module)
         from .util import class_rename_registry
         new_class = class_rename_registry.find_replacement_for_old('{}.{}'.format(module, name))
-        if new_class:
-            return new_class
-        return super(HDF5PersistentUnpickler, self).find_class(module, name)
+        if not new_class:
+            new_class = super(HDF5PersistentUnpickler, self).find_class(module, name)
+        self._classes[(module, name)] = new_class
+        return new_class
@@ -106,6 +106,63 @@ class TestSerialisation(unittest.TestCase):
         restored = inst.load(self.fn)
         self.assertEqual(restored, inst)
 
+    def test_numpy_container_small_arrays(self):
+        # small arrays are packed into a single dataset or pickled inline, check various dtypes and memory layouts.
+        x = [np.array(42.),
+             np.empty((0, 3)),
+             np.arange(10, dtype=np.float32),
+             np.array(['foo', 'bar']),
+             np.zeros(3, dtype='i4,S3'),
+             np.arange(60, dtype='>i8').reshape(6, 10)[:, ::2],
+             np.arange(12).reshape(3, 4).T,
+             np.random.random((100, 100))]
+        inst = np_container(x)
+        inst.save(self.fn)
+        restored = inst.load(self.fn)
+        self.assertEqual(restored, inst)
+        for e0, e1 in zip(restored.x, x):
+            self.assertEqual(e0.dtype, e1.dtype)
+
+    def test_numpy_container_shared_arrays(self):
+        for x in (np.arange(10), np.random.random(100000)):
+            inst = np_container(x)
+            inst.save(self.fn, overwrite=True)
+            restored = inst.load(self.fn)
+            np.testing.assert_equal(restored.x, x)
+            self.assertIs(restored.x, restored.y)
+            self.assertIs(restored.z[0], restored.x)
+            self.assertIs(restored.z[1], restored.x)
+
+    def test_numpy_container_equal_arrays(self):
+        # equal but distinct arrays are stored once, but restored as distinct objects.
+        x = np.random.random(100000)
+        inst = np_container(x)
+        inst.y = x.copy()
+        inst.save(self.fn)
+        with H5File(self.fn, model_name='default') as f:
+            n_datasets = len(f._current_model_group)
+        self.assertEqual(n_datasets, 2)  # model and x
+        restored = inst.load(self.fn)
+        np.testing.assert_equal(restored.y, x)
+        self.assertIsNot(restored.x, restored.y)
+        restored.y[0] = -1
+        self.assertEqual(restored.x[0], x[0])
+
+    def test_numpy_container_large_arrays(self):
+        # arrays above 1 MiB may be written as pre-compressed chunks, check partial edge chunks and memory layouts.
+        x = [np.random.random((301, 257, 3)).transpose(2, 1, 0),
+             np.asfortranarray(np.random.randint(0, 1000, size=(1001, 333))),
+             np.arange(600000, dtype='>i4').reshape(1000, 600)[::2, 1:],
+             ]
+        for a in x:
+            self.assertGreater(a.nbytes, 1024 * 1024)
+        inst = np_container(x)
+        inst.save(self.fn)
+        restored = inst.load(self.fn)
+        self.assertEqual(restored, inst)
+        for e0, e1 in zip(restored.x, x):
+            self.assertEqual(e0.dtype, e1.dtype)
+
     def test_save_interface(self):
         inst = test_cls_v1()
         inst.save(self.fn)
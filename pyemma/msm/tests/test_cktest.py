@@ -22,8 +22,6 @@ r"""Unit test for Chapman-Kolmogorov-Test module
 
 """
 
-import unittest
-
 import numpy as np
 import pytest
 from deeptime.data import BirthDeathChain
@@ -31,17 +29,16 @@ from deeptime.data import BirthDeathChain
 import pyemma
 
 from pyemma import msm
-from deeptime.markov.tools.estimation import count_matrix, largest_connected_set, largest_connected_submatrix, transition_matrix
+from deeptime.markov.tools.estimation import largest_connected_set, transition_matrix
 from pyemma.util.numeric import assert_allclose
 from pyemma.msm import estimate_markov_model
 
 import sys
 
 on_win = sys.platform == 'win32'
-py3 = sys.version_info[0] == 3
 
 
-@pytest.fixture
+@pytest.fixture(scope='module')
 def cktest_resource():
     """Reseed the rng to enforce 'deterministic' behavior"""
     rnd_state = np.random.mtrand.get_state()
@@ -78,12 +75,15 @@ def cktest_resource():
     K = 10
     P_MSM_dense = P_MSM
 
-    p_MSM = np.zeros((K, 2))
-    w_MSM_k = 1.0 * w_MSM
+    """Powers P^k for all k in one buffer, propagate both initial distributions at once"""
+    P_pow = np.empty((K,) + P_MSM_dense.shape)
+    P_pow[0] = np.eye(P_MSM_dense.shape[0])
     for k in range(1, K):
-        w_MSM_k = np.dot(w_MSM_k, P_MSM_dense)
-        p_MSM[k, 0] = w_MSM_k[0, A].sum()
-        p_MSM[k, 1] = w_MSM_k[1, B].sum()
+        np.matmul(P_pow[k - 1], P_MSM_dense, out=P_pow[k])
+    w_MSM_k = np.matmul(w_MSM, P_pow)
+    """A, the state in between and B are contiguous blocks, sum all of them in one pass"""
+    set_bounds = [A[0], A[-1] + 1, B[0]]
+    p_MSM = np.add.reduceat(w_MSM_k, set_bounds, axis=2)[:, [0, 1], [0, 2]]
 
     """Assume that sets are equal, A(\tau)=A(k \tau) for all k"""
     w_MD = 1.0 * w_MSM
@@ -92,31 +92,36 @@ def cktest_resource():
     p_MSM[0, :] = 1.0
     p_MD[0, :] = 1.0
     eps_MD[0, :] = 0.0
+    """Count matrices at lagtimes k*tau for all k, computed with a single bincount (sliding window)"""
+    n = int(dtraj.max()) + 1
+    dtraj_ = dtraj.astype(np.int64)
+    lags = tau * np.arange(1, K)
+    pairs = np.concatenate([(k * n + dtraj_[:-lag]) * n + dtraj_[lag:] for k, lag in enumerate(lags, 1)])
+    C_all = np.bincount(pairs, minlength=K * n * n).reshape(K, n, n).astype(np.float64)
+    C_all[1:] /= lags[:, None, None]
+    """Connectivity of a single long trajectory does not change with the lagtime, use the one at tau"""
+    lcc_MD = largest_connected_set(C_all[1])
+    if len(lcc_MD) < n:
+        C_all = C_all[:, lcc_MD[:, None], lcc_MD]
+    c_MD = C_all.sum(axis=2)
+    c_sets = np.add.reduceat(c_MD, set_bounds, axis=1)[:, [0, 2]]
+    w_MD_k = np.empty_like(w_MD)
     for k in range(1, K):
         """Build MSM at lagtime k*tau"""
-        C_MD = count_matrix(dtraj, k * tau, sliding=True) / (k * tau)
-        lcc_MD = largest_connected_set(C_MD)
-        Ccc_MD = largest_connected_submatrix(C_MD, lcc=lcc_MD)
-        c_MD = Ccc_MD.sum(axis=1)
-        P_MD = transition_matrix(Ccc_MD).toarray()
-        w_MD_k = np.dot(w_MD, P_MD)
-
-        """Set A"""
-        prob_MD = w_MD_k[0, A].sum()
-        c = c_MD[A].sum()
-        p_MD[k, 0] = prob_MD
-        eps_MD[k, 0] = np.sqrt(k * (prob_MD - prob_MD ** 2) / c)
-
-        """Set B"""
-        prob_MD = w_MD_k[1, B].sum()
-        c = c_MD[B].sum()
-        p_MD[k, 1] = prob_MD
-        eps_MD[k, 1] = np.sqrt(k * (prob_MD - prob_MD ** 2) / c)
+        P_MD = transition_matrix(C_all[k])
+        np.dot(w_MD, P_MD, out=w_MD_k)
 
-    """Input"""
-    yield MSM, p_MSM, p_MD
+        """Sets A and B"""
+        p_MD[k] = np.add.reduceat(w_MD_k, set_bounds, axis=1)[[0, 1], [0, 2]]
+    """Statistical errors of the MD estimates for all k at once"""
+    eps_MD[1:] = np.sqrt(np.arange(1, K)[:, None] * p_MD[1:] * (1.0 - p_MD[1:]) / c_sets[1:])
+
+    # the rng state is only needed during construction, restore it before the tests of this module run.
     np.random.mtrand.set_state(rnd_state)
 
+    """Input"""
+    return MSM, p_MSM, p_MD, eps_MD
+
 
 @pytest.mark.parametrize('n_jobs', [1])
 def test_cktest(n_jobs, cktest_resource):
@@ -128,151 +133,165 @@ def test_cktest(n_jobs, cktest_resource):
                             [0, 0, 1],
                             [0, 0, 1],
                             [0, 0, 1]])
-    MSM, p_MSM, p_MD = cktest_resource
+    MSM, p_MSM_ref, p_MD_ref, eps_MD_ref = cktest_resource
     ck = MSM.cktest(3, memberships=memberships, n_jobs=n_jobs)
     p_MSM = np.vstack([ck.predictions[:, 0, 0], ck.predictions[:, 2, 2]]).T
-    assert_allclose(p_MSM, p_MSM)
+    assert_allclose(p_MSM, p_MSM_ref)
     p_MD = np.vstack([ck.estimates[:, 0, 0], ck.estimates[:, 2, 2]]).T
-    assert_allclose(p_MD, p_MD)
-
-
-class TestCK_AllEstimators(unittest.TestCase):
-    """ Integration tests for various estimators
-    """
-
-    @classmethod
-    def setUpClass(cls):
-        # load double well data
-        import pyemma.datasets
-        cls.double_well_data = pyemma.datasets.load_2well_discrete()
-
-    def tearDown(self):
-        if py3:
-            import tempfile
-            with tempfile.NamedTemporaryFile(delete=False) as fh:
-                self.ck.save(fh.name)
-                restored = pyemma.load(fh.name)
-                assert hasattr(restored, 'has_errors')
-
-    def test_ck_msm(self):
-        MLMSM = msm.estimate_markov_model([self.double_well_data.dtraj_T100K_dt10_n6good], 40)
-        self.ck = MLMSM.cktest(2, mlags=[0, 1, 10], n_jobs=1)
-        estref = np.array([[[1., 0.],
-                            [0., 1.]],
-                           [[0.89806859, 0.10193141],
-                            [0.10003466, 0.89996534]],
-                           [[0.64851782, 0.35148218],
-                            [0.34411751, 0.65588249]]])
-        predref = np.array([[[1., 0.],
-                             [0., 1.]],
-                            [[0.89806859, 0.10193141],
-                             [0.10003466, 0.89996534]],
-                            [[0.62613723, 0.37386277],
-                             [0.3669059, 0.6330941]]])
-        # rough agreement with MLE
-        assert np.allclose(self.ck.estimates, estref, rtol=0.1, atol=10.0)
-        assert self.ck.estimates_conf[0] is None
-        assert self.ck.estimates_conf[1] is None
-        assert np.allclose(self.ck.predictions, predref, rtol=0.1, atol=10.0)
-        assert self.ck.predictions_conf[0] is None
-        assert self.ck.predictions_conf[1] is None
-
-    def test_its_bmsm(self):
-        BMSM = msm.bayesian_markov_model([self.double_well_data.dtraj_T100K_dt10_n6good], 40, reversible=True)
-        # also ensure that reversible bit does not flip during cktest
-        assert BMSM.reversible
-        self.ck = BMSM.cktest(2, mlags=[0, 1, 10], n_jobs=1)
-        assert BMSM.reversible
-        estref = np.array([[[1., 0.],
-                            [0., 1.]],
-                           [[0.89722931, 0.10277069],
-                            [0.10070029, 0.89929971]],
-                           [[0.64668027, 0.35331973],
-                            [0.34369109, 0.65630891]]])
-        predref = np.array([[[1., 0.],
-                             [0., 1.]],
-                            [[0.89722931, 0.10277069],
-                             [0.10070029, 0.89929971]],
-                            [[0.62568693, 0.37431307],
-                             [0.36677222, 0.63322778]]])
-        predLref = np.array([[[1., 0.],
-                              [0., 1.]],
-                             [[0.89398296, 0.09942586],
-                              [0.09746008, 0.89588256]],
-                             [[0.6074675, 0.35695492],
-                              [0.34831224, 0.61440531]]])
-        predRref = np.array([[[1., 0.],
-                              [0., 1.]],
-                             [[0.90070139, 0.10630301],
-                              [0.10456111, 0.90255169]],
-                             [[0.64392557, 0.39258944],
-                              [0.38762444, 0.65176265]]])
-        # rough agreement
-        assert np.allclose(self.ck.estimates, estref, rtol=0.1, atol=10.0)
-        assert self.ck.estimates_conf[0] is None
-        assert self.ck.estimates_conf[1] is None
-        assert np.allclose(self.ck.predictions, predref, rtol=0.1, atol=10.0)
-        assert np.allclose(self.ck.predictions[0], predLref, rtol=0.1, atol=10.0)
-        assert np.allclose(self.ck.predictions[1], predRref, rtol=0.1, atol=10.0)
-
-    def test_its_hmsm(self):
-        MLHMM = msm.estimate_hidden_markov_model([self.double_well_data.dtraj_T100K_dt10_n6good], 2, 10)
-        self.ck = MLHMM.cktest(mlags=[0, 1, 10], n_jobs=1)
-        estref = np.array([[[1., 0.],
-                            [0., 1.]],
-                           [[0.98515058, 0.01484942],
-                            [0.01442843, 0.98557157]],
-                           [[0.88172685, 0.11827315],
-                            [0.11878823, 0.88121177]]])
-        predref = np.array([[[1., 0.],
-                             [0., 1.]],
-                            [[0.98515058, 0.01484942],
-                             [0.01442843, 0.98557157]],
-                            [[0.86961812, 0.13038188],
-                             [0.12668553, 0.87331447]]])
-        # rough agreement with MLE
-        assert np.allclose(self.ck.estimates, estref, rtol=0.1, atol=10.0)
-        assert self.ck.estimates_conf[0] is None
-        assert self.ck.estimates_conf[1] is None
-        assert np.allclose(self.ck.predictions, predref, rtol=0.1, atol=10.0)
-        assert self.ck.predictions_conf[0] is None
-        assert self.ck.predictions_conf[1] is None
-
-    def test_its_bhmm(self):
-        BHMM = msm.bayesian_hidden_markov_model([self.double_well_data.dtraj_T100K_dt10_n6good], 2, 10)
-        self.ck = BHMM.cktest(mlags=[0, 1, 10], n_jobs=1)
-        estref = np.array([[[1., 0.],
-                            [0., 1.]],
-                           [[0.98497185, 0.01502815],
-                            [0.01459256, 0.98540744]],
-                           [[0.88213404, 0.11786596],
-                            [0.11877379, 0.88122621]]])
-        predref = np.array([[[1., 0.],
-                             [0., 1.]],
-                            [[0.98497185, 0.01502815],
-                             [0.01459256, 0.98540744]],
-                            [[0.86824695, 0.13175305],
-                             [0.1279342, 0.8720658]]])
-        predLref = np.array([[[1., 0.],
-                              [0., 1.]],
-                             [[0.98282734, 0.01284444],
-                              [0.0123793, 0.98296742]],
-                             [[0.8514399, 0.11369687],
-                              [0.10984971, 0.85255827]]])
-        predRref = np.array([[[1., 0.],
-                              [0., 1.]],
-                             [[0.98715575, 0.01722138],
-                              [0.0178059, 0.98762081]],
-                             [[0.8865478, 0.14905352],
-                              [0.14860461, 0.89064809]]])
-        # rough agreement
-        assert np.allclose(self.ck.estimates, estref, rtol=0.1, atol=10.0)
-        assert self.ck.estimates_conf[0] is None
-        assert self.ck.estimates_conf[1] is None
-        assert np.allclose(self.ck.predictions, predref, rtol=0.1, atol=10.0)
-        assert np.allclose(self.ck.predictions[0], predLref, rtol=0.1, atol=10.0)
-        assert np.allclose(self.ck.predictions[1], predRref, rtol=0.1, atol=10.0)
-
-
-if __name__ == "__main__":
-    unittest.main()
+    assert_allclose(p_MD, p_MD_ref)
+    # the chain is Markovian, predictions agree with the estimates within their statistical errors.
+    assert np.all(np.abs(p_MSM - p_MD) <= eps_MD_ref)
+
+
+# Integration tests for various estimators, each model is estimated and tested once per module.
+
+
+@pytest.fixture(scope='module')
+def double_well_dtrajs():
+    # load double well data
+    import pyemma.datasets
+    return [pyemma.datasets.load_2well_discrete().dtraj_T100K_dt10_n6good]
+
+
+@pytest.fixture(scope='module')
+def ck_msm(double_well_dtrajs):
+    MLMSM = msm.estimate_markov_model(double_well_dtrajs, 40)
+    return MLMSM.cktest(2, mlags=[0, 1, 10], n_jobs=1)
+
+
+@pytest.fixture(scope='module')
+def ck_bmsm(double_well_dtrajs):
+    BMSM = msm.bayesian_markov_model(double_well_dtrajs, 40, reversible=True)
+    # also ensure that reversible bit does not flip during cktest
+    assert BMSM.reversible
+    ck = BMSM.cktest(2, mlags=[0, 1, 10], n_jobs=1)
+    assert BMSM.reversible
+    return ck
+
+
+@pytest.fixture(scope='module')
+def ck_hmsm(double_well_dtrajs):
+    MLHMM = msm.estimate_hidden_markov_model(double_well_dtrajs, 2, 10)
+    return MLHMM.cktest(mlags=[0, 1, 10], n_jobs=1)
+
+
+@pytest.fixture(scope='module')
+def ck_bhmm(double_well_dtrajs):
+    BHMM = msm.bayesian_hidden_markov_model(double_well_dtrajs, 2, 10)
+    return BHMM.cktest(mlags=[0, 1, 10], n_jobs=1)
+
+
+@pytest.mark.parametrize('ck_name, estref, predref', [
+    ('ck_msm',
+     [[[1., 0.],
+       [0., 1.]],
+      [[0.89806859, 0.10193141],
+       [0.10003466, 0.89996534]],
+      [[0.64851782, 0.35148218],
+       [0.34411751, 0.65588249]]],
+     [[[1., 0.],
+       [0., 1.]],
+      [[0.89806859, 0.10193141],
+       [0.10003466, 0.89996534]],
+      [[0.62613723, 0.37386277],
+       [0.3669059, 0.6330941]]]),
+    ('ck_bmsm',
+     [[[1., 0.],
+       [0., 1.]],
+      [[0.89722931, 0.10277069],
+       [0.10070029, 0.89929971]],
+      [[0.64668027, 0.35331973],
+       [0.34369109, 0.65630891]]],
+     [[[1., 0.],
+       [0., 1.]],
+      [[0.89722931, 0.10277069],
+       [0.10070029, 0.89929971]],
+      [[0.62568693, 0.37431307],
+       [0.36677222, 0.63322778]]]),
+    ('ck_hmsm',
+     [[[1., 0.],
+       [0., 1.]],
+      [[0.98515058, 0.01484942],
+       [0.01442843, 0.98557157]],
+      [[0.88172685, 0.11827315],
+       [0.11878823, 0.88121177]]],
+     [[[1., 0.],
+       [0., 1.]],
+      [[0.98515058, 0.01484942],
+       [0.01442843, 0.98557157]],
+      [[0.86961812, 0.13038188],
+       [0.12668553, 0.87331447]]]),
+    ('ck_bhmm',
+     [[[1., 0.],
+       [0., 1.]],
+      [[0.98497185, 0.01502815],
+       [0.01459256, 0.98540744]],
+      [[0.88213404, 0.11786596],
+       [0.11877379, 0.88122621]]],
+     [[[1., 0.],
+       [0., 1.]],
+      [[0.98497185, 0.01502815],
+       [0.01459256, 0.98540744]],
+      [[0.86824695, 0.13175305],
+       [0.1279342, 0.8720658]]]),
+])
+def test_ck_estimates_predictions(ck_name, estref, predref, request):
+    ck = request.getfixturevalue(ck_name)
+    # rough agreement with MLE
+    assert np.allclose(ck.estimates, estref, rtol=0.1, atol=10.0)
+    assert ck.estimates_conf[0] is None
+    assert ck.estimates_conf[1] is None
+    assert np.allclose(ck.predictions, predref, rtol=0.1, atol=10.0)
+
+
+@pytest.mark.parametrize('ck_name', ['ck_msm', 'ck_hmsm'])
+def test_ck_mle_no_conf(ck_name, request):
+    ck = request.getfixturevalue(ck_name)
+    assert ck.predictions_conf[0] is None
+    assert ck.predictions_conf[1] is None
+
+
+@pytest.mark.parametrize('ck_name, predLref, predRref', [
+    ('ck_bmsm',
+     [[[1., 0.],
+       [0., 1.]],
+      [[0.89398296, 0.09942586],
+       [0.09746008, 0.89588256]],
+      [[0.6074675, 0.35695492],
+       [0.34831224, 0.61440531]]],
+     [[[1., 0.],
+       [0., 1.]],
+      [[0.90070139, 0.10630301],
+       [0.10456111, 0.90255169]],
+      [[0.64392557, 0.39258944],
+       [0.38762444, 0.65176265]]]),
+    ('ck_bhmm',
+     [[[1., 0.],
+       [0., 1.]],
+      [[0.98282734, 0.01284444],
+       [0.0123793, 0.98296742]],
+      [[0.8514399, 0.11369687],
+       [0.10984971, 0.85255827]]],
+     [[[1., 0.],
+       [0., 1.]],
+      [[0.98715575, 0.01722138],
+       [0.0178059, 0.98762081]],
+      [[0.8865478, 0.14905352],
+       [0.14860461, 0.89064809]]]),
+])
+def test_ck_bayesian_conf(ck_name, predLref, predRref, request):
+    ck = request.getfixturevalue(ck_name)
+    # rough agreement
+    assert np.allclose(ck.predictions[0], predLref, rtol=0.1, atol=10.0)
+    assert np.allclose(ck.predictions[1], predRref, rtol=0.1, atol=10.0)
+
+
+@pytest.mark.parametrize('ck_name', ['ck_msm', 'ck_bmsm', 'ck_hmsm', 'ck_bhmm'])
+def test_ck_save_load(ck_name, request):
+    ck = request.getfixturevalue(ck_name)
+    # round trip through an in-memory file.
+    import io
+    with io.BytesIO() as fh:
+        ck.save(fh)
+        restored = pyemma.load(fh)
+    assert hasattr(restored, 'has_errors')
@@ -18,7 +18,11 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import re as _re
 import numpy as _np
+from concurrent.futures import ThreadPoolExecutor as _ThreadPoolExecutor
+from scipy.interpolate import griddata as _griddata
+from scipy.spatial import cKDTree as _cKDTree
 from warnings import warn as _warn
 
 __author__ = 'noe'
@@ -26,14 +30,19 @@ __author__ = 'noe'
 _matplotlib_version = None
 
 
-def _get_cmap(cmap):
-    # matplotlib 2.0 deprecated 'spectral' colormap, renamed to nipy_spectral.
+def _get_matplotlib_version():
     global _matplotlib_version
     if _matplotlib_version is None:
         from matplotlib import __version__
-        from distutils.version import LooseVersion
-        _matplotlib_version = LooseVersion(__version__).version
-    if cmap == 'spectral' and _matplotlib_version >= (2, ):
+        # major and minor release, e.g. (3, 8) for '3.8.0rc1'
+        _matplotlib_version = tuple(
+            map(int, _re.match(r'(\d+)\.(\d+)', __version__).groups()))
+    return _matplotlib_version
+
+
+def _get_cmap(cmap):
+    # matplotlib 2.0 deprecated 'spectral' colormap, renamed to nipy_spectral.
+    if cmap == 'spectral' and _get_matplotlib_version() >= (2, ):
         cmap = 'nipy_spectral'
     return cmap
 
@@ -120,6 +129,129 @@ def scatter_contour(
 # ######################################################################
 
 
+def _bin_edges(a, nbins):
+    """Edges of nbins equally sized bins spanning the range of a.
+
+    Bins are chosen as in numpy.histogram: a zero range is widened
+    to one unit and empty samples span the unit interval.
+
+    Parameters
+    ----------
+    a : ndarray(T)
+        Sample coordinates.
+    nbins : int
+        Number of bins.
+
+    Returns
+    -------
+    edges : ndarray(nbins + 1)
+        The bin edges.
+
+    """
+    if a.size == 0:
+        first, last = 0.0, 1.0
+    else:
+        first, last = a.min(), a.max()
+    # integers and half precision would overflow the bin scale.
+    if not _np.issubdtype(a.dtype, _np.inexact) or a.dtype.itemsize < 4:
+        first, last = float(first), float(last)
+    if not (_np.isfinite(first) and _np.isfinite(last)):
+        raise ValueError(
+            'autodetected range of [{}, {}] is not finite'.format(
+                first, last))
+    if first == last:
+        first, last = first - 0.5, last + 0.5
+    return _np.linspace(first, last, nbins + 1)
+
+
+def _bin_indices(a, edges):
+    """Assign samples to equally sized bins; the last bin includes
+    its right edge.
+
+    Parameters
+    ----------
+    a : ndarray(T)
+        Sample coordinates, floating point.
+    edges : ndarray(nbins + 1)
+        Equally spaced bin edges.
+
+    Returns
+    -------
+    indices : ndarray(T)
+        Bin index of each sample.
+
+    """
+    nbins = len(edges) - 1
+    first, last = edges[0], edges[-1]
+    indices = ((a - first) * (nbins / (last - first))).astype(_np.intp)
+    indices[indices == nbins] -= 1
+    # correct for rounding errors at the bin edges
+    indices[a < edges[indices]] -= 1
+    indices[(a >= edges[indices + 1]) & (indices != nbins - 1)] += 1
+    return indices
+
+
+_HISTOGRAM_CHUNK_SIZE = 1 << 20
+
+
+def _histogram2d_uniform(xall, yall, nbins, weights=None):
+    """Two-dimensional histogram with equally sized bins.
+
+    The samples are binned in chunks, which keeps the temporaries
+    small and lets numpy run the chunks in parallel threads.
+
+    Returns
+    -------
+    z : ndarray(nbins, nbins)
+        Histogram counts, the first axis corresponds to y.
+    x : ndarray(nbins)
+        The bin centers in x.
+    y : ndarray(nbins)
+        The bin centers in y.
+
+    """
+    xedge = _bin_edges(xall, nbins)
+    yedge = _bin_edges(yall, nbins)
+    # binning takes several passes over each chunk, so these are made
+    # contiguous (e.g. columns of a trajectory) and floating point once.
+    xtype, ytype = (
+        _np.result_type(a.dtype, _np.float32)
+        if _np.issubdtype(a.dtype, _np.inexact) else _np.float64
+        for a in (xall, yall))
+
+    def count(start):
+        chunk = slice(start, start + _HISTOGRAM_CHUNK_SIZE)
+        ix = _bin_indices(
+            _np.ascontiguousarray(xall[chunk], dtype=xtype), xedge)
+        iy = _bin_indices(
+            _np.ascontiguousarray(yall[chunk], dtype=ytype), yedge)
+        iy *= nbins
+        iy += ix
+        if weights is None:
+            # integer counting, no floating point accumulation
+            return _np.bincount(iy, minlength=nbins * nbins)
+        return _np.bincount(
+            iy, weights=weights[chunk], minlength=nbins * nbins)
+
+    starts = range(0, len(xall), _HISTOGRAM_CHUNK_SIZE)
+    if len(starts) > 1:
+        with _ThreadPoolExecutor() as executor:
+            counts = executor.map(count, starts)
+            z = next(counts)
+            for c in counts:
+                z += c
+    else:
+        z = count(0)
+    z = z.reshape(nbins, nbins).astype(_np.float64, copy=False)
+    # all bins have the same width, so are their centers.
+    x, y = (
+        _np.linspace(
+            edge[0] + 0.5 * (edge[-1] - edge[0]) / nbins,
+            edge[-1] - 0.5 * (edge[-1] - edge[0]) / nbins, nbins)
+        for edge in (xedge, yedge))
+    return z, x, y
+
+
 def get_histogram(
         xall, yall, nbins=100,
         weights=None, avoid_zero_count=False):
@@ -150,13 +282,56 @@ def get_histogram(
         Histogram counts in meshgrid format.
 
     """
-    z, xedge, yedge = _np.histogram2d(
-        xall, yall, bins=nbins, weights=weights)
-    x = 0.5 * (xedge[:-1] + xedge[1:])
-    y = 0.5 * (yedge[:-1] + yedge[1:])
+    if _np.isscalar(nbins):
+        # equally sized bins: compute bin indices directly instead of
+        # searching the edges as histogram2d does.
+        z, x, y = _histogram2d_uniform(
+            _np.asarray(xall), _np.asarray(yall), int(nbins),
+            weights=None if weights is None else _np.asarray(weights))
+    else:
+        # swap x and y to obtain z in meshgrid orientation.
+        if len(nbins) == 2:
+            nbins = nbins[::-1]
+        z, yedge, xedge = _np.histogram2d(
+            yall, xall, bins=nbins, weights=weights)
+        x = 0.5 * (xedge[:-1] + xedge[1:])
+        y = 0.5 * (yedge[:-1] + yedge[1:])
     if avoid_zero_count:
-        z = _np.maximum(z, _np.min(z[z.nonzero()]))
-    return x, y, z.T # transpose to match x/y-directions
+        _np.maximum(z, _np.min(z, where=z != 0, initial=z.max()), out=z)
+    return x, y, z
+
+
+def _interpolate_on_grid(xall, yall, zall, nbins, method):
+    """Interpolate unstructured two-dimensional data on a regular grid.
+
+    Returns
+    -------
+    x : ndarray(nbins)
+        The grid's x-coordinates.
+    y : ndarray(nbins)
+        The grid's y-coordinates.
+    z : ndarray(nbins, nbins)
+        Interpolated z-data, the first axis corresponds to x.
+
+    """
+    x = _np.linspace(xall.min(), xall.max(), nbins)
+    y = _np.linspace(yall.min(), yall.max(), nbins)
+    # qhull works on doubles, fill the points in that type right away.
+    points = _np.empty((len(xall), 2))
+    points[:, 0] = xall
+    points[:, 1] = yall
+    # the coordinates are broadcast, no need for a full meshgrid.
+    if method == 'nearest':
+        # same KD-tree lookup as griddata, but queried in parallel.
+        grid = _np.empty((nbins, nbins, 2))
+        grid[..., 0] = x[:, None]
+        grid[..., 1] = y[None, :]
+        _, nearest = _cKDTree(points).query(grid, workers=-1)
+        z = _np.asarray(zall)[nearest]
+    else:
+        z = _griddata(
+            points, zall, (x[:, None], y[None, :]), method=method)
+    return x, y, z
 
 
 def get_grid_data(xall, yall, zall, nbins=100, method='nearest'):
@@ -186,19 +361,14 @@ def get_grid_data(xall, yall, zall, nbins=100, method='nearest'):
         Interpolated z-data in meshgrid format.
 
     """
-    from scipy.interpolate import griddata
-    x, y = _np.meshgrid(
-        _np.linspace(xall.min(), xall.max(), nbins),
-        _np.linspace(yall.min(), yall.max(), nbins),
-        indexing='ij')
-    z = griddata(
-        _np.hstack([xall[:,None], yall[:,None]]),
-        zall, (x, y), method=method)
+    x, y, z = _interpolate_on_grid(xall, yall, zall, nbins, method)
+    x, y = _np.meshgrid(x, y, indexing='ij')
     return x, y, z
 
 
 def _to_density(z):
-    """Normalize histogram counts.
+    """Normalize histogram counts; empty bins are set to NaN, which
+    contourf leaves blank.
 
     Parameters
     ----------
@@ -206,7 +376,8 @@ def _to_density(z):
         Histogram counts.
 
     """
-    return z / float(z.sum())
+    return _np.true_divide(
+        z, z.sum(), out=_np.full(z.shape, _np.nan), where=z > 0)
 
 
 def _to_free_energy(z, minener_zero=False):
@@ -225,12 +396,17 @@ def _to_free_energy(z, minener_zero=False):
         The free energy values in units of kT.
 
     """
-    pi = _to_density(z)
-    free_energy = _np.inf * _np.ones(shape=z.shape)
-    nonzero = pi.nonzero()
-    free_energy[nonzero] = -_np.log(pi[nonzero])
+    # -log(z / z.sum()) on the populated bins, without normalizing z first
+    nonzero = z > 0
+    free_energy = _np.full(z.shape, _np.inf)
+    _np.log(z, out=free_energy, where=nonzero)
+    _np.subtract(
+        _np.log(z.sum()), free_energy, out=free_energy, where=nonzero)
     if minener_zero:
-        free_energy[nonzero] -= _np.min(free_energy[nonzero])
+        _np.subtract(
+            free_energy,
+            _np.min(free_energy, where=nonzero, initial=_np.inf),
+            out=free_energy, where=nonzero)
     return free_energy
 
 
@@ -245,7 +421,8 @@ def _prune_kwargs(kwargs):
     """
     allowed_keys = [
         'corner_mask', 'alpha', 'locator', 'extend', 'xunits',
-        'yunits', 'antialiased', 'nchunk', 'hatches', 'zorder']
+        'yunits', 'antialiased', 'nchunk', 'hatches', 'zorder',
+        'algorithm']
     ignored = [key for key in kwargs.keys() if key not in allowed_keys]
     for key in ignored:
         _warn(
@@ -255,6 +432,10 @@ def _prune_kwargs(kwargs):
     return kwargs
 
 
+_THREADED_CONTOUR_MIN_SIZE = 200 * 200
+_THREADED_CONTOUR_CHUNK = 64
+
+
 def plot_map(
         x, y, z, ax=None, cmap=None,
         ncontours=100, vmin=None, vmax=None, levels=None,
@@ -336,6 +517,11 @@ def plot_map(
         slightly less RAM. It can however introduce rendering
         artifacts at chunk boundaries depending on the backend, the
         antialiased flag and value of alpha.
+    algorithm : [ 'mpl2005' | 'mpl2014' | 'serial' | 'threaded' ]
+        The contouring algorithm (requires matplotlib >= 3.6).
+        'threaded' traces the subdomains given by nchunk in
+        parallel threads; this is the default (with nchunk=64)
+        for grids of at least 200x200 points.
     hatches :
         A list of cross hatch patterns to use on the filled areas.
         If None, no hatching will be added to the contour. Hatching
@@ -361,10 +547,17 @@ def plot_map(
         fig, ax = _plt.subplots()
     else:
         fig = ax.get_figure()
+    kwargs = _prune_kwargs(kwargs)
+    if (_np.size(z) >= _THREADED_CONTOUR_MIN_SIZE
+            and 'algorithm' not in kwargs
+            and _get_matplotlib_version() >= (3, 6)):
+        # trace large grids in tiles, which contourpy runs in parallel.
+        kwargs.update(algorithm='threaded')
+        kwargs.setdefault('nchunk', _THREADED_CONTOUR_CHUNK)
     mappable = ax.contourf(
         x, y, z, ncontours, norm=norm,
         vmin=vmin, vmax=vmax, cmap=cmap,
-        levels=levels, **_prune_kwargs(kwargs))
+        levels=levels, **kwargs)
     misc = dict(mappable=mappable)
     if cbar_orientation not in ('horizontal', 'vertical'):
         raise ValueError(
@@ -477,6 +670,11 @@ def plot_density(
         slightly less RAM. It can however introduce rendering
         artifacts at chunk boundaries depending on the backend, the
         antialiased flag and value of alpha.
+    algorithm : [ 'mpl2005' | 'mpl2014' | 'serial' | 'threaded' ]
+        The contouring algorithm (requires matplotlib >= 3.6).
+        'threaded' traces the subdomains given by nchunk in
+        parallel threads; this is the default (with nchunk=64)
+        for grids of at least 200x200 points.
     hatches :
         A list of cross hatch patterns to use on the filled areas.
         If None, no hatching will be added to the contour. Hatching
@@ -501,15 +699,14 @@ def plot_density(
         xall, yall, nbins=nbins, weights=weights,
         avoid_zero_count=avoid_zero_count)
     pi = _to_density(z)
-    pi = _np.ma.masked_where(pi <= 0, pi)
     if logscale:
         from matplotlib.colors import LogNorm
         norm = LogNorm(vmin=vmin, vmax=vmax)
         if levels is None:
+            # range of the populated bins
+            lmin, lmax = _np.log10((_np.nanmin(pi), _np.nanmax(pi)))
             levels = _np.logspace(
-                _np.floor(_np.log10(pi.min())),
-                _np.ceil(_np.log10(pi.max())),
-                ncontours + 1)
+                _np.floor(lmin), _np.ceil(lmax), ncontours + 1)
     else:
         norm = None
     fig, ax, misc = plot_map(
@@ -627,6 +824,11 @@ def plot_free_energy(
         slightly less RAM. It can however introduce rendering
         artifacts at chunk boundaries depending on the backend, the
         antialiased flag and value of alpha.
+    algorithm : [ 'mpl2005' | 'mpl2014' | 'serial' | 'threaded' ]
+        The contouring algorithm (requires matplotlib >= 3.6).
+        'threaded' traces the subdomains given by nchunk in
+        parallel threads; this is the default (with nchunk=64)
+        for grids of at least 200x200 points.
     hatches :
         A list of cross hatch patterns to use on the filled areas.
         If None, no hatching will be added to the contour. Hatching
@@ -676,7 +878,8 @@ def plot_free_energy(
     x, y, z = get_histogram(
         xall, yall, nbins=nbins, weights=weights,
         avoid_zero_count=avoid_zero_count)
-    f = _to_free_energy(z, minener_zero=minener_zero) * kT
+    f = _to_free_energy(z, minener_zero=minener_zero)
+    f *= kT
     fig, ax, misc = plot_map(
         x, y, f, ax=ax, cmap=cmap,
         ncontours=ncontours, vmin=vmin, vmax=vmax, levels=levels,
@@ -778,6 +981,11 @@ def plot_contour(
         slightly less RAM. It can however introduce rendering
         artifacts at chunk boundaries depending on the backend, the
         antialiased flag and value of alpha.
+    algorithm : [ 'mpl2005' | 'mpl2014' | 'serial' | 'threaded' ]
+        The contouring algorithm (requires matplotlib >= 3.6).
+        'threaded' traces the subdomains given by nchunk in
+        parallel threads; this is the default (with nchunk=64)
+        for grids of at least 200x200 points.
     hatches :
         A list of cross hatch patterns to use on the filled areas.
         If None, no hatching will be added to the contour. Hatching
@@ -798,13 +1006,18 @@ def plot_contour(
         if requested, a matplotlib.Colorbar object 'cbar'.
 
     """
-    x, y, z = get_grid_data(
+    x, y, z = _interpolate_on_grid(
         xall, yall, zall, nbins=nbins, method=method)
-    if vmin is None:
-        vmin = _np.min(zall[zall > -_np.inf])
-    if vmax is None:
-        vmax = _np.max(zall[zall < _np.inf])
-    if levels == 'legacy':
+    # contourf only reads the coordinates, broadcast views suffice.
+    x = _np.broadcast_to(x[:, None], z.shape)
+    y = _np.broadcast_to(y, z.shape)
+    if vmin is None or vmax is None:
+        finite = zall[_np.isfinite(zall)]
+        if vmin is None:
+            vmin = finite.min()
+        if vmax is None:
+            vmax = finite.max()
+    if isinstance(levels, str) and levels == 'legacy':
         eps = (vmax - vmin) / float(ncontours)
         levels = _np.linspace(vmin - eps, vmax + eps)
     if mask:
@@ -897,6 +1110,11 @@ def plot_state_map(
         slightly less RAM. It can however introduce rendering
         artifacts at chunk boundaries depending on the backend, the
         antialiased flag and value of alpha.
+    algorithm : [ 'mpl2005' | 'mpl2014' | 'serial' | 'threaded' ]
+        The contouring algorithm (requires matplotlib >= 3.6).
+        'threaded' traces the subdomains given by nchunk in
+        parallel threads; this is the default (with nchunk=64)
+        for grids of at least 200x200 points.
     hatches :
         A list of cross hatch patterns to use on the filled areas.
         If None, no hatching will be added to the contour. Hatching
@@ -25,6 +25,7 @@ from pyemma.plots.plots2d import plot_density
 from pyemma.plots.plots2d import plot_free_energy
 from pyemma.plots.plots2d import plot_contour
 from pyemma.plots.plots2d import plot_state_map
+from pyemma.plots.plots2d import get_histogram
 
 
 class TestPlots2d(unittest.TestCase):
@@ -32,6 +33,31 @@ class TestPlots2d(unittest.TestCase):
     def setUpClass(cls):
         cls.data = np.random.binomial(10, 0.4, (100, 2))
 
+    def test_get_histogram(self):
+        xall = np.random.normal(size=1000)
+        yall = np.random.normal(size=1000)
+        weights = np.random.uniform(size=1000)
+        for data in ((xall, yall), (self.data[:, 0], self.data[:, 1])):
+            for w in (None, weights[:len(data[0])]):
+                x, y, z = get_histogram(*data, nbins=20, weights=w)
+                zref, xedge, yedge = np.histogram2d(*data, bins=20, weights=w)
+                np.testing.assert_allclose(x, 0.5 * (xedge[:-1] + xedge[1:]))
+                np.testing.assert_allclose(y, 0.5 * (yedge[:-1] + yedge[1:]))
+                np.testing.assert_allclose(z, zref.T)
+
+    def test_get_histogram_half_precision_and_empty(self):
+        xall = (1 + 1e-3 * np.random.uniform(size=1000)).astype(np.float16)
+        yall = np.random.uniform(size=1000).astype(np.float16)
+        x, y, z = get_histogram(xall, yall, nbins=100)
+        zref, xedge, yedge = np.histogram2d(
+            xall.astype(np.float64), yall.astype(np.float64), bins=100)
+        np.testing.assert_allclose(x, 0.5 * (xedge[:-1] + xedge[1:]))
+        np.testing.assert_allclose(z, zref.T)
+        x, y, z = get_histogram(np.empty(0), np.empty(0), nbins=20)
+        zref, xedge, yedge = np.histogram2d([], [], bins=20)
+        np.testing.assert_allclose(x, 0.5 * (xedge[:-1] + xedge[1:]))
+        np.testing.assert_allclose(z, zref.T)
+
     def test_free_energy(self):
         fig, ax = plot_free_energy(
             self.data[:, 0], self.data[:, 1])
@@ -63,6 +89,10 @@ class TestPlots2d(unittest.TestCase):
         fig, ax, misc = plot_density(
             self.data[:, 0], self.data[:, 1], zorder=-1)
         plt.close(fig)
+        fig, ax, misc = plot_density(
+            self.data[:, 0], self.data[:, 1],
+            algorithm='threaded', nchunk=10)
+        plt.close(fig)
         fig, ax, misc = plot_density(
             self.data[:, 0], self.data[:, 1],
             this_should_raise_a_UserWarning=True)
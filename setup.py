@@ -295,14 +295,14 @@ metadata = dict(
     # runtime dependencies
     install_requires=[
         'decorator>=4.0.0',
-        'h5py>=2.7.1',
+        'h5py>=2.9',
         'matplotlib',
         'mdtraj>=1.9.2',
-        'numpy>=1.8.0',
+        'numpy>=1.17',
         'pathos',
         'psutil>=3.1.1',
         'pyyaml',
-        'scipy>=0.11',
+        'scipy>=1.6',
         'tqdm>=4.23',
         'deeptime>=0.4.2'
     ],